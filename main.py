@@ -1,20 +1,28 @@
 import html
 import json
 import logging
+import pickle
+import threading
+import time
 import traceback
-from io import StringIO
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from os import fdopen, fsync, remove, replace
+from os.path import basename, dirname
 from os import makedirs
 from os import makedirs
-from tempfile import TemporaryFile
+from tempfile import mkstemp
 from typing import Optional
-from urllib.parse import urlsplit
 
 import requests
+import urllib3
+from cachetools import TTLCache
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-try:
-    import re2 as re
-except ImportError:
-    import re
+import re2 as re
 import telegram.error
 from telegram import Update, InputMediaDocument, InputMediaAnimation, constants, BotCommand, BotCommandScopeChat
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext, PicklePersistence
@@ -24,134 +32,356 @@ from config import BOT_TOKEN, DEVELOPER_ID, IS_BOT_PRIVATE
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
+LOG_LEVELS = {name.lower(): getattr(logging, name) for name in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')}
+
+MAX_MEDIA_GROUP_LENGTH = 10  # Telegram limit for photos in one media group
+# BadRequest messages Telegram returns when it can't fetch media by url
+MEDIA_FETCH_ERRORS = ('wrong file identifier/http url specified', 'failed to get http url content',
+                      'wrong type of the web page content')
+# Handlers mostly wait on network I/O, so run more of them than the default 4 threads
+DISPATCHER_WORKERS = 16
+
+# Shared HTTP session, keeps connections to Twitter and vxtwitter alive between requests
+session = requests.Session()
+session.headers.update({'User-Agent': 'twitter_downloader_bot (+https://github.com/skrimix/twitter_downloader_bot)'})
+# Transient errors are retried, the last response is returned so raise_for_status still applies.
+# Rate limiting (429) is not retried, it would only burn more quota, the error is reported to the user instead.
+# Retry-After is ignored, an arbitrarily long wait would block shared worker threads for every chat
+retries = Retry(total=3, backoff_factor=0.25, status_forcelist=(500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']), respect_retry_after_header=False,
+                raise_on_status=False)
+session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=64, max_retries=retries))
+# Pool for running blocking HTTP requests concurrently
+http_executor = ThreadPoolExecutor(max_workers=DISPATCHER_WORKERS)
+# Requests one message can have queued in the pool at once, so a message with many links can't occupy it
+MAX_REQUESTS_PER_MESSAGE = 4
+
+# Recently scraped tweet media, handlers run concurrently so access is guarded by a lock
+media_cache = TTLCache(maxsize=4096, ttl=600)
+# API errors are remembered briefly, so repeatedly sent broken tweets don't hit the API every time
+api_error_cache = TTLCache(maxsize=1024, ttl=60)
+media_cache_lock = threading.Lock()
+
+# Guards bot_data['stats'] updates, handlers run concurrently
+stats_lock = threading.Lock()
+
+# Precompiled link patterns
+TCO_LINK_RE = re.compile(r"t\.co\/[a-zA-Z0-9]+")
+TWEET_ID_RE = re.compile(r"(?:twitter|x)\.com/.{1,15}/(?:web|status(?:es)?)/([0-9]{1,20})")
+# <meta content="{message}" property="og:description" />
+OG_DESCRIPTION_RE = re.compile(r'<meta content="(.*?)" property="og:description" />')
 
 class APIException(Exception):
     pass
 
 
+class AtomicPicklePersistence(PicklePersistence):
+    """PicklePersistence that writes to a temporary file and renames it over the target,
+    so a crash during a flush can't leave a truncated file behind."""
+
+    @staticmethod
+    def _dump_file(filename: str, data: object) -> None:
+        # Unique temporary file, the periodic flush and the shutdown flush can run at the same time
+        fd, tmp_filename = mkstemp(prefix=basename(filename) + '.', suffix='.tmp', dir=dirname(filename) or '.')
+        try:
+            with fdopen(fd, 'wb') as file:
+                pickle.dump(data, file)
+                file.flush()
+                fsync(file.fileno())
+            replace(tmp_filename, filename)
+        except BaseException:
+            remove(tmp_filename)
+            raise
+
+    def _dump_singlefile(self) -> None:
+        data = {
+            'conversations': self.conversations,
+            'user_data': self.user_data,
+            'chat_data': self.chat_data,
+            'bot_data': self.bot_data,
+            'callback_data': self.callback_data,
+        }
+        self._dump_file(self.filename, data)
+
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _take(self) -> float:
+        """Take a token if available. Return 0 on success, otherwise seconds until one is available."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self) -> None:
+        """Block until a token is available and take it."""
+        while delay := self._take():
+            time.sleep(delay)
+
+    def try_acquire(self) -> bool:
+        """Take a token without blocking. Return False if none is available."""
+        return not self._take()
+
+
+# Outgoing message rate limits, shape bursts instead of hitting Telegram flood limits.
+# Chat buckets are re-inserted on every use, so only buckets idle for the whole TTL expire.
+# Those are full again by then, so dropping them doesn't let a chat burst past the limit
+global_send_bucket = TokenBucket(constants.MAX_MESSAGES_PER_SECOND, constants.MAX_MESSAGES_PER_SECOND)
+chat_send_buckets = TTLCache(maxsize=1024, ttl=60)
+chat_send_buckets_lock = threading.Lock()
+
+# Messages handled at the same time per chat, so one chat waiting on its rate limit can't occupy every worker
+MAX_HANDLERS_PER_CHAT = 2
+chat_handlers_in_flight = {}
+chat_handlers_in_flight_lock = threading.Lock()
+
+
+def submit_limited(fn: Callable, items: Iterable) -> Iterator[Future]:
+    """Run fn for each item in http_executor and yield the futures in order.
+    At most MAX_REQUESTS_PER_MESSAGE of them are submitted ahead of the one being consumed."""
+    pending = deque()
+    for item in items:
+        if len(pending) >= MAX_REQUESTS_PER_MESSAGE:
+            yield pending.popleft()
+        pending.append(http_executor.submit(fn, item))
+    yield from pending
+
+
 def extract_tweet_ids(update: Update) -> Optional[list[str]]:
     """Extract tweet IDs from message."""
     text = update.effective_message.text
 
-    # For t.co links
-    unshortened_links = ''
-    for link in re.findall(r"t\.co\/[a-zA-Z0-9]+", text):
+    # Cheap substring check before running the regexes, most messages don't contain links
+    if 't.co/' not in text and 'twitter.com/' not in text and 'x.com/' not in text:
+        return None
+
+    # Parse IDs from received text, t.co links only need unshortening if there are any
+    tweet_ids = TWEET_ID_RE.findall(text)
+    tco_links = TCO_LINK_RE.findall(text)
+    if tweet_ids and not tco_links:
+        return list(dict.fromkeys(tweet_ids))
+
+    # For t.co links, HEAD is enough to follow the redirects, they are unshortened concurrently
+    unshorten_futures = submit_limited(
+        lambda link: session.head('https://' + link, allow_redirects=True, timeout=10), tco_links)
+    for link, unshorten_future in zip(tco_links, unshorten_futures):
         try:
-            unshortened_link = requests.get('https://' + link).url
-            unshortened_links += '\n' + unshortened_link
-            log_handling(update, 'info', f'Unshortened t.co link [https://{link} -> {unshortened_link}]')
+            unshortened_link = unshorten_future.result().url
+            tweet_ids += TWEET_ID_RE.findall(unshortened_link)
+            log_handling(update, 'info', 'Unshortened t.co link [https://%s -> %s]', link, unshortened_link)
         except:
-            log_handling(update, 'info', f'Could not unshorten link [https://{link}]')
+            log_handling(update, 'info', 'Could not unshorten link [https://%s]', link)
 
-    # Parse IDs from received text
-    tweet_ids = re.findall(r"(?:twitter|x)\.com/.{1,15}/(?:web|status(?:es)?)/([0-9]{1,20})", text + unshortened_links)
-    tweet_ids = list(dict.fromkeys(tweet_ids))
+    # Usually there is only one ID, deduplicate only when needed
+    if len(tweet_ids) > 1:
+        tweet_ids = list(dict.fromkeys(tweet_ids))
     return tweet_ids or None
 
 
 def scrape_media(tweet_id: int) -> list[dict]:
-    r = requests.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}')
+    with media_cache_lock:
+        if (media := media_cache.get(tweet_id)) is not None:
+            return media
+        if (error := api_error_cache.get(tweet_id)) is not None:
+            raise APIException(error)
+
+    r = session.get(f'https://api.vxtwitter.com/Twitter/status/{tweet_id}', timeout=10)
     r.raise_for_status()
     try:
-        return r.json()['media_extended']
+        media = r.json()['media_extended']
     except requests.exceptions.JSONDecodeError: # the api likely returned an HTML page, try looking for an error message
-        # <meta content="{message}" property="og:description" />
-        if match := re.search(r'<meta content="(.*?)" property="og:description" />', r.text):
-            raise APIException(f'API returned error: {html.unescape(match.group(1))}')
+        if match := OG_DESCRIPTION_RE.search(r.text):
+            error = f'API returned error: {html.unescape(match.group(1))}'
+            with media_cache_lock:
+                api_error_cache[tweet_id] = error
+            raise APIException(error)
         raise
-        
 
-def reply_media(update: Update, context: CallbackContext, tweet_media: list) -> bool:
+    if media:
+        with media_cache_lock:
+            media_cache[tweet_id] = media
+    return media
+
+
+def reply_media(update: Update, stats: dict, tweet_media: list) -> bool:
     """Reply to message with supported media."""
-    photos = [media for media in tweet_media if media["type"] == "image"]
-    gifs = [media for media in tweet_media if media["type"] == "gif"]
-    videos = [media for media in tweet_media if media["type"] == "video"]
+    photos, gifs, videos = [], [], []
+    media_by_type = {'image': photos, 'gif': gifs, 'video': videos}
+    for media in tweet_media:
+        if (media_list := media_by_type.get(media['type'])) is not None:
+            media_list.append(media)
     if photos:
-        reply_photos(update, context, photos)
+        reply_photos(update, stats, photos)
     if gifs:
-        reply_gifs(update, context, gifs)
+        reply_gifs(update, stats, gifs)
     elif videos:
-        reply_videos(update, context, videos)
+        reply_videos(update, stats, videos)
     return bool(photos or gifs or videos)
 
 
-def reply_photos(update: Update, context: CallbackContext, twitter_photos: list[dict]) -> None:
+def reply_photos(update: Update, stats: dict, twitter_photos: list[dict]) -> None:
     """Reply with photo group."""
-    photo_group = []
-    for photo in twitter_photos:
-        photo_url = photo['url']
-        log_handling(update, 'info', f'Photo[{len(photo_group)}] url: {photo_url}')
-        parsed_url = urlsplit(photo_url)
-
-        # Try changing requested quality to 'orig'
+    photo_urls = [photo['url'] for photo in twitter_photos]
+    # Request 'orig' quality directly, Telegram fails the whole group if any of them is not available
+    orig_urls = [photo_url.split('?', 1)[0] + '?format=jpg&name=orig' for photo_url in photo_urls]
+    for i, (photo_url, orig_url) in enumerate(zip(photo_urls, orig_urls)):
+        log_handling(update, 'info', 'Photo[%d] url: %s, orig url: %s', i, photo_url, orig_url)
+
+    for start in range(0, len(photo_urls), MAX_MEDIA_GROUP_LENGTH):
+        group = slice(start, start + MAX_MEDIA_GROUP_LENGTH)
+        # Only notify about the first group
+        disable_notification = start > 0
         try:
-            new_url = parsed_url._replace(query='format=jpg&name=orig').geturl()
-            log_handling(update, 'info', 'New photo url: ' + new_url)
-            requests.head(new_url).raise_for_status()
-            photo_group.append(InputMediaDocument(media=new_url))
-        except requests.HTTPError:
-            log_handling(update, 'info', 'orig quality not available, using original url')
-            photo_group.append(InputMediaDocument(media=photo_url))
-    update.effective_message.reply_media_group(photo_group, quote=True)
-    log_handling(update, 'info', f'Sent photo group (len {len(photo_group)})')
-    context.bot_data['stats']['media_downloaded'] += len(photo_group)
-
-
-def reply_gifs(update: Update, context: CallbackContext, twitter_gifs: list[dict]):
+            photo_group = [InputMediaDocument(media=orig_url) for orig_url in orig_urls[group]]
+            wait_for_send_slot(update)
+            update.effective_message.reply_media_group(photo_group, quote=True,
+                                                       disable_notification=disable_notification)
+        except telegram.error.BadRequest as exc:
+            # Only errors about fetching the media can be fixed by using other urls
+            if not any(error in exc.message.lower() for error in MEDIA_FETCH_ERRORS):
+                raise
+            log_handling(update, 'info', 'Could not send orig quality photos (%s), checking which are available',
+                         exc.message)
+            increment_stat(stats, 'photo_group_fallbacks')
+            # Check orig urls concurrently, only unavailable ones fall back to the original url.
+            # If all of them are available, something else failed, so use the original urls for all photos
+            orig_available = [future.result() for future in submit_limited(is_url_available, orig_urls[group])]
+            if all(orig_available):
+                orig_available = [False] * len(orig_available)
+            photo_group = [InputMediaDocument(media=orig_url if available else photo_url)
+                           for orig_url, photo_url, available in zip(orig_urls[group], photo_urls[group], orig_available)]
+            wait_for_send_slot(update)
+            update.effective_message.reply_media_group(photo_group, quote=True,
+                                                       disable_notification=disable_notification)
+        log_handling(update, 'info', 'Sent photo group (len %d)', len(photo_group))
+        increment_stat(stats, 'media_downloaded', len(photo_group))
+
+
+def is_url_available(url: str) -> bool:
+    """Check if url is reachable with a HEAD request."""
+    try:
+        session.head(url, timeout=10).raise_for_status()
+        return True
+    except requests.RequestException:
+        return False
+
+
+def reply_gifs(update: Update, stats: dict, twitter_gifs: list[dict]):
     """Reply with GIF animations."""
     for gif in twitter_gifs:
         gif_url = gif['url']
-        log_handling(update, 'info', f'Gif url: {gif_url}')
+        log_handling(update, 'info', 'Gif url: %s', gif_url)
+        wait_for_send_slot(update)
         update.effective_message.reply_animation(animation=gif_url, quote=True)
         log_handling(update, 'info', 'Sent gif')
-        context.bot_data['stats']['media_downloaded'] += 1
+        increment_stat(stats, 'media_downloaded')
 
 
-def reply_videos(update: Update, context: CallbackContext, twitter_videos: list[dict]):
+def reply_videos(update: Update, stats: dict, twitter_videos: list[dict]):
     """Reply with videos."""
     for video in twitter_videos:
         video_url = video['url']
         try:
-            request = requests.get(video_url, stream=True)
-            request.raise_for_status()
-            if (video_size := int(request.headers['Content-Length'])) <= constants.MAX_FILESIZE_DOWNLOAD:
+            # Only the size is needed to pick the send method, the video is downloaded only for upload
+            head = session.head(video_url, allow_redirects=True, timeout=10)
+            head.raise_for_status()
+            if (video_size := int(head.headers['Content-Length'])) <= constants.MAX_FILESIZE_DOWNLOAD:
                 # Try sending by url
+                wait_for_send_slot(update)
                 update.effective_message.reply_video(video=video_url, quote=True)
                 log_handling(update, 'info', 'Sent video (download)')
             elif video_size <= constants.MAX_FILESIZE_UPLOAD:
-                log_handling(update, 'info', f'Video size ({video_size}) is bigger than '
-                                            f'MAX_FILESIZE_UPLOAD, using upload method')
+                log_handling(update, 'info', 'Video size (%d) is bigger than MAX_FILESIZE_UPLOAD, using upload method',
+                             video_size)
+                wait_for_send_slot(update)
                 message = update.effective_message.reply_text(
                     'Video is too large for direct download\nUsing upload method '
                     '(this might take a bit longer)',
                     quote=True)
-                with TemporaryFile() as tf:
-                    log_handling(update, 'info', f'Downloading video (Content-length: '
-                                                f'{request.headers["Content-length"]})')
-                    for chunk in request.iter_content(chunk_size=128):
-                        tf.write(chunk)
-                    log_handling(update, 'info', 'Video downloaded, uploading to Telegram')
-                    tf.seek(0)
-                    update.effective_message.reply_video(video=tf, quote=True, supports_streaming=True)
-                    log_handling(update, 'info', 'Sent video (upload)')
-                message.delete()
+                try:
+                    with session.get(video_url, stream=True, timeout=30) as request:
+                        request.raise_for_status()
+                        log_handling(update, 'info', 'Relaying video to Telegram (Content-length: %s)',
+                                     request.headers['Content-length'])
+                        # python-telegram-bot reads the whole file object into memory before uploading anyway,
+                        # so read the response stream directly instead of spooling it through a file on disk
+                        request.raw.decode_content = True
+                        video_filename = video_url.split('?', 1)[0].rsplit('/', 1)[-1]
+                        wait_for_send_slot(update)
+                        update.effective_message.reply_video(video=request.raw, filename=video_filename, quote=True,
+                                                             supports_streaming=True)
+                        log_handling(update, 'info', 'Sent video (upload)')
+                finally:
+                    # Don't leave the status message behind when the download or upload fails
+                    message.delete()
             else:
                 log_handling(update, 'info', 'Video is too large, sending direct link')
+                wait_for_send_slot(update)
                 update.effective_message.reply_text(f'Video is too large for Telegram upload. Direct video link:\n'
                                         f'{video_url}', quote=True)
-        except (requests.HTTPError, KeyError, telegram.error.BadRequest, requests.exceptions.ConnectionError) as exc:
-            log_handling(update, 'info', f'{exc.__class__.__qualname__}: {exc}')
+        except (requests.HTTPError, KeyError, telegram.error.BadRequest, requests.exceptions.ConnectionError,
+                requests.exceptions.Timeout, urllib3.exceptions.HTTPError) as exc:
+            log_handling(update, 'info', '%s: %s', exc.__class__.__qualname__, exc)
             log_handling(update, 'info', 'Error occurred when trying to send video, sending direct link')
+            wait_for_send_slot(update)
             update.effective_message.reply_text(f'Error occurred when trying to send video. Direct link:\n'
                                     f'{video_url}', quote=True)
-        context.bot_data['stats']['media_downloaded'] += 1
+        increment_stat(stats, 'media_downloaded')
+
+
+def get_chat_send_bucket(chat_id: int) -> TokenBucket:
+    """Get the rate limit bucket of the chat, creating it if needed."""
+    with chat_send_buckets_lock:
+        if (bucket := chat_send_buckets.get(chat_id)) is None:
+            bucket = TokenBucket(constants.MAX_MESSAGES_PER_SECOND_PER_CHAT, 3)
+        # Setting the item again refreshes its TTL, a plain get doesn't
+        chat_send_buckets[chat_id] = bucket
+    return bucket
+
+
+def wait_for_send_slot(update: Update) -> None:
+    """Block until a message can be sent to the chat without exceeding rate limits.
+    Only for run_async handlers, blocking the dispatcher thread would stall every chat."""
+    get_chat_send_bucket(update.effective_chat.id).acquire()
+    global_send_bucket.acquire()
+
+
+def has_send_slot(update: Update) -> bool:
+    """Non-blocking variant of wait_for_send_slot for handlers running on the dispatcher thread.
+    Return False if the reply should be dropped to stay within rate limits."""
+    if get_chat_send_bucket(update.effective_chat.id).try_acquire() and global_send_bucket.try_acquire():
+        return True
+    log_handling(update, 'info', 'Rate limit reached, not replying')
+    return False
+
+
+def increment_stat(stats: dict, key: str, amount: int = 1) -> None:
+    """Atomically increment a bot stats counter."""
+    with stats_lock:
+        stats[key] = stats.get(key, 0) + amount
 
 
 # TODO: use LoggerAdapter instead
-def log_handling(update: Update, level: str, message: str) -> None:
-    """Log message with chat_id and message_id."""
-    _level = getattr(logging, level.upper())
-    logger.log(_level, f'[{update.effective_chat.id}:{update.effective_message.message_id}] {message}')
+def log_handling(update: Update, level: str, message: str, *args) -> None:
+    """Log message with chat_id and message_id. Message is formatted with args lazily, %-style."""
+    _level = LOG_LEVELS[level]
+    if not logger.isEnabledFor(_level):
+        return
+    chat_id = update.effective_chat.id
+    message_id = update.effective_message.message_id
+    logger.log(_level, '[%s:%s] ' + message, chat_id, message_id, *args)
 
 
 def error_handler(update: object, context: CallbackContext) -> None:
@@ -173,45 +403,37 @@ def error_handler(update: object, context: CallbackContext) -> None:
     if update is None:
         return
 
-    # traceback.format_exception returns the usual python message about an exception, but as a
-    # list of strings rather than a single string, so we have to join them together.
-    tb_list = traceback.format_exception(None, context.error, context.error.__traceback__)
-    tb_string = ''.join(tb_list)
+    # TracebackException.format yields the usual python message about an exception line by line,
+    # so we have to join them together.
+    tb_string = ''.join(traceback.TracebackException.from_exception(context.error).format())
 
-    # Build the message with some markup and additional information about what happened.
+    # Build the report with additional information about what happened.
     update_str = update.to_dict() if isinstance(update, Update) else str(update)
-    message = (
-        f'#error_report\n'
-        f'An exception was raised in runtime\n'
-        f'<pre>update = {html.escape(json.dumps(update_str, indent=2, ensure_ascii=False))}'
-        '</pre>\n\n'
-        f'<pre>context.chat_data = {html.escape(str(context.chat_data))}</pre>\n\n'
-        f'<pre>context.user_data = {html.escape(str(context.user_data))}</pre>\n\n'
-        f'<pre>{html.escape(tb_string)}</pre>'
-    )
 
     # Finally, send the message
     logger.info('Sending error report')
     message = (
-        f'update = {json.dumps(update_str, indent=2, ensure_ascii=False)}'
+        f'update = {json.dumps(update_str, indent=2, ensure_ascii=False, default=str)}'
         '\n\n'
         f'context.chat_data = {str(context.chat_data)}\n\n'
         f'context.user_data = {str(context.user_data)}\n\n'
         f'{tb_string}'
     )
-    string_out = StringIO(message)
-    context.bot.send_document(chat_id=DEVELOPER_ID, document=string_out, filename='error_report.txt',
+    report_file = BytesIO(message.encode('utf-8'))
+    context.bot.send_document(chat_id=DEVELOPER_ID, document=report_file, filename='error_report.txt',
                               caption='#error_report\nAn exception was raised in runtime\n')
 
-    if update:
+    if update and has_send_slot(update):
         error_class_name = ".".join([context.error.__class__.__module__, context.error.__class__.__qualname__])
         update.effective_message.reply_text(f'Error\n{error_class_name}: {str(context.error)}')
 
 
 def start(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /start is issued."""
-    log_handling(update, 'info', f'Received /start command from userId {update.effective_user.id}')
+    log_handling(update, 'info', 'Received /start command from userId %s', update.effective_user.id)
     user = update.effective_user
+    if not has_send_slot(update):
+        return
     update.effective_message.reply_markdown_v2(
         fr'Hi {user.mention_markdown_v2()}\!' +
         '\nSend tweet link here and I will download media in the best available quality for you'
@@ -220,94 +442,143 @@ def start(update: Update, context: CallbackContext) -> None:
 
 def help_command(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /help is issued."""
+    if not has_send_slot(update):
+        return
     update.effective_message.reply_text('Send tweet link here and I will download media in the best available quality for you')
 
 
 def stats_command(update: Update, context: CallbackContext) -> None:
     """Send stats when the command /stats is issued."""
-    if not 'stats' in context.bot_data:
-        context.bot_data['stats'] = {'messages_handled': 0, 'media_downloaded': 0}
-        logger.info('Initialized stats')
-    logger.info(f'Sent stats: {context.bot_data["stats"]}')
-    update.effective_message.reply_markdown_v2(f'*Bot stats:*\nMessages handled: *{context.bot_data["stats"].get("messages_handled")}*'
-                                     f'\nMedia downloaded: *{context.bot_data["stats"].get("media_downloaded")}*')
+    with stats_lock:
+        stats = dict(context.bot_data['stats'])
+    if not has_send_slot(update):
+        return
+    logger.info(f'Sent stats: {stats}')
+    update.effective_message.reply_markdown_v2(f'*Bot stats:*\nMessages handled: *{stats.get("messages_handled")}*'
+                                     f'\nMedia downloaded: *{stats.get("media_downloaded")}*'
+                                     f'\nOrig photo fallbacks: *{stats.get("photo_group_fallbacks", 0)}*')
 
 
 def reset_stats_command(update: Update, context: CallbackContext) -> None:
     """Reset stats when the command /resetstats is issued."""
-    stats = {'messages_handled': 0, 'media_downloaded': 0}
-    context.bot_data['stats'] = stats
+    # Zero the existing dict in place, handlers in progress keep a reference to it
+    with stats_lock:
+        stats = context.bot_data['stats']
+        stats.clear()
+        stats.update({'messages_handled': 0, 'media_downloaded': 0, 'photo_group_fallbacks': 0})
     logger.info("Bot stats have been reset")
+    if not has_send_slot(update):
+        return
     update.effective_message.reply_text("Bot stats have been reset")
 
 
 def deny_access(update: Update, context: CallbackContext) -> None:
     """Deny unauthorized access"""
     log_handling(update, 'info',
-                 f'Access denied to {update.effective_user.full_name} (@{update.effective_user.username}),'
-                 f' userId {update.effective_user.id}')
+                 'Access denied to %s (@%s), userId %s',
+                 update.effective_user.full_name, update.effective_user.username, update.effective_user.id)
+    if not has_send_slot(update):
+        return
     update.effective_message.reply_text(f'Access denied. Your id ({update.effective_user.id}) is not whitelisted')
 
 
 def handle_message(update: Update, context: CallbackContext) -> None:
-    """Handle the user message. Reply with found supported media."""
-    log_handling(update, 'info', 'Received message: ' + update.effective_message.text.replace("\n", ""))
-    if not 'stats' in context.bot_data:
-        context.bot_data['stats'] = {'messages_handled': 0, 'media_downloaded': 0}
-        logger.info('Initialized stats')
-    context.bot_data['stats']['messages_handled'] += 1
+    """Handle the user message, limiting how many messages of one chat are processed at the same time."""
+    chat_id = update.effective_chat.id
+    with chat_handlers_in_flight_lock:
+        in_flight = chat_handlers_in_flight.get(chat_id, 0)
+        if in_flight < MAX_HANDLERS_PER_CHAT:
+            chat_handlers_in_flight[chat_id] = in_flight + 1
+    if in_flight >= MAX_HANDLERS_PER_CHAT:
+        log_handling(update, 'info', 'Too many messages in progress for this chat, ignoring message')
+        if has_send_slot(update):
+            update.effective_message.reply_text('Too many links in progress, please wait and try again', quote=True)
+        return
+
+    try:
+        process_message(update, context)
+    finally:
+        with chat_handlers_in_flight_lock:
+            if (in_flight := chat_handlers_in_flight[chat_id] - 1) > 0:
+                chat_handlers_in_flight[chat_id] = in_flight
+            else:
+                del chat_handlers_in_flight[chat_id]
+
+
+def process_message(update: Update, context: CallbackContext) -> None:
+    """Process the user message. Reply with found supported media."""
+    log_handling(update, 'info', 'Received message: %s', update.effective_message.text.replace("\n", ""))
+    stats = context.bot_data['stats']
+    increment_stat(stats, 'messages_handled')
 
     if tweet_ids := extract_tweet_ids(update):
-        log_handling(update, 'info', f'Found Tweet IDs {tweet_ids} in message')
+        log_handling(update, 'info', 'Found Tweet IDs %s in message', tweet_ids)
     else:
         log_handling(update, 'info', 'No supported tweet link found')
+        wait_for_send_slot(update)
         update.effective_message.reply_text('No supported tweet link found', quote=True)
         return
     found_media = False
     found_tweets = False
-    for tweet_id in tweet_ids:
-        # Scrape a single tweet by ID
-        log_handling(update, 'info', f'Scraping tweet ID {tweet_id}')
+    # Scrape tweets concurrently, replies are still sent in the original order
+    log_handling(update, 'info', 'Scraping tweet IDs %s', tweet_ids)
+    scrape_futures = submit_limited(scrape_media, tweet_ids)
+    for tweet_id, scrape_future in zip(tweet_ids, scrape_futures):
         try:
-            media = scrape_media(tweet_id)
+            media = scrape_future.result()
             found_tweets = True
             if media:
-                log_handling(update, 'info', f'tweet media: {media}')
-                if reply_media(update, context, media):
+                log_handling(update, 'info', 'tweet media: %s', media)
+                if reply_media(update, stats, media):
                     found_media = True
                 else:
-                    log_handling(update, 'info', f'Found unsupported media: {media[0]["type"]}')
+                    log_handling(update, 'info', 'Found unsupported media: %s', media[0]["type"])
             else:
-                log_handling(update, 'info', f'Tweet {tweet_id} has no media')
+                log_handling(update, 'info', 'Tweet %s has no media', tweet_id)
+                wait_for_send_slot(update)
                 update.effective_message.reply_text(f'Tweet {tweet_id} has no media', quote=True)
         except APIException as exc:
-            log_handling(update, 'error', f'Error occurred when scraping tweet {tweet_id}: {traceback.format_exc()}')
+            log_handling(update, 'error', 'Error occurred when scraping tweet %s: %s', tweet_id, traceback.format_exc())
+            wait_for_send_slot(update)
             update.effective_message.reply_text(f'Error occurred when scraping tweet {tweet_id}\n{exc}', quote=True)
         except Exception:
-            log_handling(update, 'error', f'Error occurred when scraping tweet {tweet_id}: {traceback.format_exc()}')
+            log_handling(update, 'error', 'Error occurred when scraping tweet %s: %s', tweet_id, traceback.format_exc())
+            wait_for_send_slot(update)
             update.effective_message.reply_text(f'Error handling tweet {tweet_id}', quote=True)
             
 
     if found_tweets and not found_media:
         log_handling(update, 'info', 'No supported media found')
+        wait_for_send_slot(update)
         update.effective_message.reply_text('No supported media found', quote=True)
 
 def handle_channel_post(update: Update, context: CallbackContext) -> None:
-    log_handling(update, 'info', f'Leaving channel {update.effective_chat.id}')
+    log_handling(update, 'info', 'Leaving channel %s', update.effective_chat.id)
     update.effective_chat.leave()
 
 
+def flush_persistence(context: CallbackContext) -> None:
+    """Write persisted data (stats) to disk."""
+    context.dispatcher.persistence.flush()
+
+
 def main() -> None:
     """Start the bot."""
     makedirs('data', exist_ok=True)  # Create data
-    persistence = PicklePersistence(filename='data/persistence')
+    # Only write to disk periodically and on shutdown instead of after every handled update
+    persistence = AtomicPicklePersistence(filename='data/persistence', on_flush=True)
 
     # Create the Updater and pass it your bot's token.
-    updater = Updater(BOT_TOKEN, persistence=persistence)
+    updater = Updater(BOT_TOKEN, workers=DISPATCHER_WORKERS, persistence=persistence)
 
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
+    # Initialize stats once, they are loaded from persistence if already present
+    if 'stats' not in dispatcher.bot_data:
+        dispatcher.bot_data['stats'] = {'messages_handled': 0, 'media_downloaded': 0, 'photo_group_fallbacks': 0}
+        logger.info('Initialized stats')
+
     # Get the bot to set commands menu
     bot = dispatcher.bot
 
@@ -359,14 +630,21 @@ def main() -> None:
 
     dispatcher.add_error_handler(error_handler)
 
-    # Start the Bot
-    updater.start_polling()
+    updater.job_queue.run_repeating(flush_persistence, interval=60, first=60)
+
+    # Start the Bot, only receive update types that have handlers and use longer long polling
+    # (MessageHandler also handles edited messages and channel posts, so those are kept)
+    updater.start_polling(allowed_updates=[Update.MESSAGE, Update.EDITED_MESSAGE, Update.CHANNEL_POST,
+                                           Update.EDITED_CHANNEL_POST], timeout=30)
 
     # Run the bot until you press Ctrl-C or the process receives SIGINT,
     # SIGTERM or SIGABRT. This should be used most of the time, since
     # start_polling() is non-blocking and will stop the bot gracefully.
     updater.idle()
 
+    # Save updates from run_async handlers that finished after the flush done when stopping the updater
+    persistence.flush()
+
 
 if __name__ == '__main__':
     main()